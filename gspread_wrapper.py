@@ -1,8 +1,20 @@
-import re
+import os
+import json
+import time
 import gspread
 import datetime as dt
 import logging as log
-from tenacity import retry, stop_after_attempt
+from typing import Any, Iterator
+from functools import lru_cache
+from contextlib import contextmanager
+from tenacity import (
+    RetryCallState,
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_exponential_jitter,
+)
+from google.auth.exceptions import TransportError
 from google.oauth2 import service_account
 
 expense_type_list: list[str] = [
@@ -20,111 +32,322 @@ expense_type_list: list[str] = [
     "遊興費",
     "雑費",
 ]
+_expense_type_index: dict[str, int] = {
+    t: i for i, t in enumerate(expense_type_list)
+}
+_COLUMN_CACHE_TTL_SEC = 24 * 60 * 60
+
+_RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+_backoff = wait_exponential_jitter(initial=1, max=60)
+
+
+def _is_retryable(e: BaseException) -> bool:
+    if isinstance(e, gspread.exceptions.APIError):
+        return e.response.status_code in _RETRYABLE_STATUS_CODES
+    # network failures (requests' exceptions derive from OSError)
+    return isinstance(e, (OSError, TransportError))
+
+
+def _wait_retry_after(retry_state: RetryCallState) -> float:
+    e = retry_state.outcome.exception() if retry_state.outcome else None
+    if isinstance(e, gspread.exceptions.APIError):
+        retry_after = e.response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), 60.0)
+    return _backoff(retry_state)
+
+
+_api_retry = retry(
+    stop=stop_after_attempt(5),
+    wait=_wait_retry_after,
+    retry=retry_if_exception(_is_retryable),
+    reraise=True,
+)
+
+
+class _DigitTable(dict[int, int | None]):
+    """translation table for str.translate that keeps only decimal digits"""
+
+    def __missing__(self, key: int) -> int | None:
+        value = key if chr(key).isdecimal() else None
+        self[key] = value
+        return value
+
+
+_DIGITS_ONLY = _DigitTable()
+
+
+@lru_cache(maxsize=1024)
+def str2int(s: str) -> int:
+    return int(s.translate(_DIGITS_ONLY) or 0)
+
+
+def _build_column_index(values: list[list[str]]) -> dict[str, str]:
+    """map each yyyy/mm/dd value to the first cell it appears in"""
+    columns: dict[str, str] = {}
+    for i, row in enumerate(values, start=1):
+        for j, value in enumerate(row, start=1):
+            if value.count("/") == 2 and value not in columns:
+                columns[value] = gspread.utils.rowcol_to_a1(i, j)
+    return columns
+
+
+def _today_str() -> str:
+    return dt.datetime.today().date().isoformat().replace("-", "/")
+
+
+def _grid_value(values: list[list[str]], label: str) -> str:
+    row, col = gspread.utils.a1_to_rowcol(label)
+    try:
+        return values[row - 1][col - 1]
+    except IndexError:
+        return ""
 
 
 class GspreadHandler:
-    def __init__(self, book_name: str) -> None:
+    sheetname_list: tuple[str, ...] = (
+        "Jan",
+        "Feb",
+        "Mar",
+        "Apr",
+        "May",
+        "Jun",
+        "Jul",
+        "Aug",
+        "Sep",
+        "Oct",
+        "Nov",
+        "Dec",
+    )
+    _shared_client: gspread.Client | None = None
+    _shared_workbooks: dict[str, gspread.Spreadsheet] = {}
+
+    def __init__(self, book_name: str, cache_dir: str | None = None) -> None:
         log.info("start 'GspreadHandler' constructor")
-        credentials = service_account.Credentials.from_service_account_file(
-            "credentials.json",
-            scopes=[
-                "https://spreadsheets.google.com/feeds",
-                "https://www.googleapis.com/auth/drive",
-            ],
-        )
-        self.client = gspread.authorize(credentials)
-        self.workbook = self.client.open(book_name)
+        if GspreadHandler._shared_client is None:
+            credentials = service_account.Credentials.from_service_account_file(
+                "credentials.json",
+                scopes=[
+                    "https://spreadsheets.google.com/feeds",
+                    "https://www.googleapis.com/auth/drive",
+                ],
+            )
+            GspreadHandler._shared_client = gspread.authorize(credentials)
+        self.client = GspreadHandler._shared_client
+        if book_name not in GspreadHandler._shared_workbooks:
+            GspreadHandler._shared_workbooks[book_name] = self.client.open(
+                book_name
+            )
+        self.workbook = GspreadHandler._shared_workbooks[book_name]
+        self.cache_dir = cache_dir
+        self._pending_writes: list[tuple[str, str]] | None = None
+        self._sheets_by_title: dict[str, gspread.Worksheet] = {}
+        self._column_index: dict[str, dict[str, str]] = {}
+        self._sheet_values: dict[str, list[list[str]]] = {}
+        self._formula_values: dict[str, Any] = {}
+        self.sheetname = ""
         self.load_sheet()
         log.info("end 'GspreadHandler' constructor")
 
-    @retry(stop=stop_after_attempt(3))
+    @_api_retry
     def load_sheet(self) -> None:
         log.info("start 'load_sheet' method")
-        sheetname_list: list[str] = [
-            "Jan",
-            "Feb",
-            "Mar",
-            "Apr",
-            "May",
-            "Jun",
-            "Jul",
-            "Aug",
-            "Sep",
-            "Oct",
-            "Nov",
-            "Dec",
-        ]
         today = dt.datetime.today()
-        sheetname = sheetname_list[today.month - 1]
-        sheets = self.workbook.worksheets()
-        if not any([sheetname == s.title for s in sheets]):
-            raise ValueError(f"sheetname '{sheetname}' not found.")
+        sheetname = self.sheetname_list[today.month - 1]
+        if sheetname == self.sheetname:
+            log.info("end 'load_sheet' method")
+            return
+        if not self._sheets_by_title:
+            self._sheets_by_title = {
+                s.title: s for s in self.workbook.worksheets()
+            }
+        if sheetname not in self._sheets_by_title:
+            try:
+                sheet = self.workbook.worksheet(sheetname)
+            except gspread.exceptions.WorksheetNotFound:
+                raise ValueError(f"sheetname '{sheetname}' not found.")
+            self._sheets_by_title[sheetname] = sheet
         self.sheetname = sheetname
-        self.sheet = self.workbook.worksheet(self.sheetname)
+        self.sheet = self._sheets_by_title[sheetname]
+        self._formula_values.clear()
         log.info("end 'load_sheet' method")
 
     def get_column(self) -> str:
         log.info("start 'get_column' method")
+        column = self._get_header_label().rstrip("0123456789")
+        log.info("end 'get_column' method")
+        return column
+
+    def _get_header_label(self) -> str:
+        log.info("start '_get_header_label' method")
         try:
-            t = dt.datetime.today()
-            today_str = t.date().isoformat()
-            today_str = today_str.replace("-", "/")
-            cell = self.sheet.find(today_str)
-            if cell:
-                match_result = re.match("[A-Z]+", cell.address)
-                if match_result:
-                    return match_result[0]
+            today_str = _today_str()
+            columns = self._column_index.get(self.sheetname)
+            if columns is None:
+                columns = self._load_column_index()
+            if columns is None or today_str not in columns:
+                self._fetch_sheet_values()
+                columns = self._column_index[self.sheetname]
+            if today_str in columns:
+                return columns[today_str]
             raise ValueError(
                 f"'{today_str}' not found in sheet '{self.sheetname}'."
             )
         finally:
-            log.info("end 'get_column' method")
+            log.info("end '_get_header_label' method")
+
+    @_api_retry
+    def _fetch_sheet_values(self) -> list[list[str]]:
+        log.info("start '_fetch_sheet_values' method")
+        values = self.sheet.get_all_values()
+        self._sheet_values[self.sheetname] = values
+        self._column_index[self.sheetname] = _build_column_index(values)
+        self._save_column_index()
+        log.info("end '_fetch_sheet_values' method")
+        return values
+
+    def _get_sheet_values(self) -> list[list[str]]:
+        values = self._sheet_values.get(self.sheetname)
+        if values is None:
+            values = self._fetch_sheet_values()
+        return values
+
+    def _column_cache_path(self) -> str | None:
+        if not self.cache_dir:
+            return None
+        return os.path.join(
+            self.cache_dir, f"columns_{self.workbook.id}_{self.sheetname}.json"
+        )
+
+    def _load_column_index(self) -> dict[str, str] | None:
+        path = self._column_cache_path()
+        if path is None:
+            return None
+        try:
+            if time.time() - os.path.getmtime(path) > _COLUMN_CACHE_TTL_SEC:
+                return None
+            with open(path, encoding="utf-8") as f:
+                columns: dict[str, str] = json.load(f)
+            for label in columns.values():
+                gspread.utils.a1_to_rowcol(label)
+        except (OSError, ValueError, gspread.exceptions.IncorrectCellLabel):
+            return None
+        log.debug(f"column index loaded from {path}")
+        self._column_index[self.sheetname] = columns
+        return columns
+
+    def _save_column_index(self) -> None:
+        path = self._column_cache_path()
+        if path is None:
+            return
+        try:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(self._column_index[self.sheetname], f)
+        except OSError:
+            log.warning(f"failed to write column index cache: {path}")
+
+    def invalidate_column_index(self) -> None:
+        log.info("start 'invalidate_column_index' method")
+        self._column_index.pop(self.sheetname, None)
+        path = self._column_cache_path()
+        if path is not None:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                log.warning(f"failed to remove column index cache: {path}")
+        log.info("end 'invalidate_column_index' method")
+
+    @_api_retry
+    def _prefetch_cells(self, labels: list[str]) -> None:
+        log.info("start '_prefetch_cells' method")
+        # render date cells as displayed, not as serial numbers, so the
+        # header check in register_expense can compare them with today
+        date_option = gspread.utils.DateTimeOption.formatted_string
+        value_ranges = self.sheet.batch_get(
+            labels,
+            value_render_option=gspread.worksheet.ValueRenderOption.formula,
+            date_time_render_option=date_option,
+        )
+        for label, value_range in zip(labels, value_ranges):
+            self._formula_values[label] = value_range.first()
+        log.info("end '_prefetch_cells' method")
+
+    def _forget_cached_values(self) -> None:
+        self._sheet_values.pop(self.sheetname, None)
+        self._formula_values.clear()
 
     def get_row(self, expense_type: str, offset: int = 31) -> int:
         log.info("start 'get_row' method")
-        row = offset + expense_type_list.index(expense_type)
+        try:
+            row = offset + _expense_type_index[expense_type]
+        except KeyError:
+            raise ValueError(f"unknown expense type '{expense_type}'.")
         log.info("end 'get_row' method")
         return row
 
-    @retry(stop=stop_after_attempt(3))
+    @_api_retry
     def add_amount_data(self, label: str, amount: int) -> None:
         log.info("start 'add_amount_data' method")
-        cell = self.sheet.acell(
-            label,
-            value_render_option=gspread.worksheet.ValueRenderOption.formula,
-        )
-        if cell.value == 0:
+        values = self._sheet_values.get(self.sheetname)
+        value: Any
+        if label in self._formula_values:
+            value = self._formula_values[label]
+        elif values is not None and _grid_value(values, label) == "":
+            # an empty cell has no formula to append to
+            value = None
+        else:
+            value = self.sheet.acell(
+                label,
+                value_render_option=gspread.worksheet.ValueRenderOption.formula,
+            ).value
+        if value == 0:
             new_value = f"={amount}"
-        elif isinstance(cell.value, int):
-            new_value = f"={cell.value}+{amount}"
-        elif isinstance(cell.value, str):
-            new_value = f"{cell.value}+{amount}"
+        elif isinstance(value, int):
+            new_value = f"={value}+{amount}"
+        elif isinstance(value, str):
+            new_value = f"{value}+{amount}"
         else:
             new_value = str(amount)
         log.debug(f"writing: '{new_value}' to {label} in {self.sheetname}")
         log.info("end 'add_amount_data' method")
-        self.sheet.update_acell(label, new_value)
+        self._write_cell(label, new_value)
 
-    @retry(stop=stop_after_attempt(3))
+    @_api_retry
     def add_memo(
         self, column: str, expense_type: str, memo: str, offset: int = 51
     ) -> None:
         log.info("start 'add_memo' method")
-        cell_range = f"{column}{offset}:{column}{offset+3}"
-        cells = self.sheet.range(cell_range)
-        non_empty_counts = len(
-            list(filter(lambda c: c.value != "" and c.value is not None, cells))
-        )
-        cells = list(
-            filter(
-                lambda c: isinstance(c.value, str) and expense_type in c.value,
-                cells,
-            )
-        )
-        if len(cells):
-            cell = cells[0]
-            new_value = f"{cell.value}, {memo}"
-            address = cell.address
+        labels = self._memo_labels(column, offset)
+        values = self._sheet_values.get(self.sheetname)
+        memo_values: list[Any]
+        if all(label in self._formula_values for label in labels):
+            memo_values = [self._formula_values[label] for label in labels]
+        elif values is not None:
+            memo_values = [_grid_value(values, label) for label in labels]
+        else:
+            cell_range = f"{labels[0]}:{labels[-1]}"
+            memo_values = [
+                row[0] if row else ""
+                for row in self.sheet.get_values(cell_range)
+            ]
+        non_empty_counts = 0
+        match_address = ""
+        match_value = ""
+        for label, value in zip(labels, memo_values):
+            if value != "" and value is not None:
+                non_empty_counts += 1
+            if (
+                not match_address
+                and isinstance(value, str)
+                and expense_type in value
+            ):
+                match_address = label
+                match_value = value
+        if match_address:
+            new_value = f"{match_value}, {memo}"
+            address = match_address
         else:
             new_value = f"{expense_type}: {memo}"
             address = f"{column}{offset+non_empty_counts}"
@@ -133,47 +356,86 @@ class GspreadHandler:
                 return
         log.debug(f"writing: '{new_value}' to {address} in {self.sheetname}")
         log.info("end 'add_memo' method")
-        self.sheet.update_acell(address, new_value)
+        self._write_cell(address, new_value)
+
+    def _memo_labels(self, column: str, offset: int = 51) -> list[str]:
+        return [f"{column}{offset+i}" for i in range(4)]
 
     def register_expense(
         self, expense_type: str, amount: int, memo: str = ""
     ) -> None:
         log.info("start 'register_expense' method")
+        header = self._get_header_label()
         column = self.get_column()
         row = self.get_row(expense_type)
         label = f"{column}{row}"
-        self.add_amount_data(label, amount)
-        if memo:
-            self.add_memo(column, expense_type, memo)
+        if self.sheetname not in self._sheet_values:
+            # the column came from the index cache: check its date header
+            # and fetch the amount formula and memo cells in one request
+            labels = [header, label]
+            if memo:
+                labels += self._memo_labels(column)
+            self._prefetch_cells(labels)
+            if self._formula_values[header] != _today_str():
+                log.warning(f"column index cache is stale at {header}")
+                self.invalidate_column_index()
+                self._formula_values.clear()
+                self._fetch_sheet_values()
+                column = self.get_column()
+                label = f"{column}{row}"
+        with self.batched_writes():
+            self.add_amount_data(label, amount)
+            if memo:
+                self.add_memo(column, expense_type, memo)
         log.info("end 'register_expense' method")
 
-    @retry(stop=stop_after_attempt(3))
+    @contextmanager
+    def batched_writes(self) -> Iterator[None]:
+        log.info("start 'batched_writes' context")
+        self._pending_writes = []
+        try:
+            yield
+            self._flush_writes(self._pending_writes)
+        finally:
+            self._pending_writes = None
+            log.info("end 'batched_writes' context")
+
+    def _write_cell(self, label: str, value: str) -> None:
+        if self._pending_writes is None:
+            self.sheet.update_acell(label, value)
+            self._forget_cached_values()
+        else:
+            self._pending_writes.append((label, value))
+
+    @_api_retry
+    def _flush_writes(self, writes: list[tuple[str, str]]) -> None:
+        if not writes:
+            return
+        log.debug(f"flushing {len(writes)} writes to {self.sheetname}")
+        # batch_update rewrites each "range" in place with the sheet title,
+        # so build the request body afresh on every (retried) attempt
+        self.sheet.batch_update(
+            [{"range": label, "values": [[value]]} for label, value in writes],
+            value_input_option=gspread.utils.ValueInputOption.user_entered,
+        )
+        self._forget_cached_values()
+
     def get_todays_expenses(self, offset: int = 31) -> str:
         log.info("start 'get_today_expenses' method")
+        values = self._get_sheet_values()
         column = self.get_column()
-        cell_range = (
-            f"{column}{offset}:{column}{offset+len(expense_type_list)-1}"
-        )
-        cells = self.sheet.range(cell_range)
-
-        def str2int(s: str) -> int:
-            return int(re.sub(r"[^\d]", "", s))
 
-        expense_list: list[gspread.Cell] = list(
-            filter(lambda c: str2int(str(c.value)) > 0, cells)
-        )
-        log.debug(f"expense_list: {expense_list}")
-        todays_expenses: list[dict] = [
-            {
-                "expense_type": expense_type_list[str2int(c.address) - offset],
-                "amount": str(c.value),
-            }
-            for c in expense_list
-        ]
-        if len(expense_list):
-            sum_amount = sum([str2int(str(c.value)) for c in expense_list])
-        else:
-            sum_amount = 0
+        todays_expenses: list[dict] = []
+        sum_amount = 0
+        for i, expense_type in enumerate(expense_type_list):
+            value = _grid_value(values, f"{column}{offset+i}")
+            amount = str2int(value)
+            if amount == 0:
+                continue
+            todays_expenses.append(
+                {"expense_type": expense_type, "amount": value}
+            )
+            sum_amount += amount
         log.info(f"todays_expenses: {todays_expenses}")
         if sum_amount:
             result = "📝"
@@ -186,28 +448,30 @@ class GspreadHandler:
         else:
             result = ""
         result += f"\n🔢合計: ¥{sum_amount:,}"
-        budget_left = self.get_budget_left(offset=offset)
+        budget_label = f"{column}{offset+len(expense_type_list)+4}"
+        budget_left = self._format_budget_left(
+            _grid_value(values, budget_label)
+        )
         result += f"\n{budget_left}"
         log.info("end 'get_today_expenses' method")
         return result
 
-    @retry(stop=stop_after_attempt(3))
     def get_budget_left(self, offset: int = 31) -> str:
         log.info("start 'get_budget_left' method")
+        values = self._get_sheet_values()
         column = self.get_column()
         cell_range = f"{column}{offset+len(expense_type_list)+4}"
-        cell = self.sheet.acell(cell_range)
-
-        def str2int(s: str) -> int:
-            return int(re.sub(r"[^\d]", "", s))
-
-        budget_left = str2int(str(cell.value))
-        log.debug(f"cell: {cell}")
-        log.debug(f"budget_left: {budget_left}")
-        result = f"残予算: ¥{budget_left:,}/日"
+        value = _grid_value(values, cell_range)
+        log.debug(f"value: {value}")
+        result = self._format_budget_left(value)
         log.info("end 'get_budget_left' method")
         return result
 
+    def _format_budget_left(self, value: str) -> str:
+        budget_left = str2int(value)
+        log.debug(f"budget_left: {budget_left}")
+        return f"残予算: ¥{budget_left:,}/日"
+
 
 if __name__ == "__main__":
     BOOKNAME = "CF (2024年度)"
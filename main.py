@@ -39,7 +39,9 @@ async def main(args: argparse.Namespace) -> None:
         bookname = f"CF ({current_fiscal_year}年度)"
         if args.check_todays_expenses:
             loop.run_in_executor(None, lambda: toast("データ取得中.."))
-            handler = GspreadHandler(bookname)
+            handler = GspreadHandler(bookname, cache_dir=HOME + "/tmp/expense")
+            if args.refresh_cache:
+                handler.invalidate_column_index()
             todays_expenses = handler.get_todays_expenses()
             t = datetime.datetime.today()
             today_str = t.date().isoformat()
@@ -59,7 +61,9 @@ async def main(args: argparse.Namespace) -> None:
             # if not res:
             #     return
             loop.run_in_executor(None, lambda: toast("登録中.."))
-            handler = GspreadHandler(bookname)
+            handler = GspreadHandler(bookname, cache_dir=HOME + "/tmp/expense")
+            if args.refresh_cache:
+                handler.invalidate_column_index()
             handler.register_expense(expense_type, expense_amount, expense_memo)
             notify(
                 "家計簿への登録が完了しました。",
@@ -257,5 +261,13 @@ if __name__ == "__main__":
         action="store_true",
         help="check today's expenses",
     )
+    parser.add_argument(
+        "-r",
+        "--refresh-cache",
+        dest="refresh_cache",
+        default=False,
+        action="store_true",
+        help="drop the cached date column index before running",
+    )
     args = parser.parse_args()
     asyncio.run(main(args))
@@ -0,0 +1,174 @@
+import os
+import json
+import datetime as dt
+from typing import Any, Iterator
+
+import gspread
+import pytest
+import requests
+
+import gspread_wrapper
+from gspread_wrapper import GspreadHandler
+
+TODAY = dt.date.today().isoformat().replace("-", "/")
+SHEETNAME = GspreadHandler.sheetname_list[dt.date.today().month - 1]
+
+
+def api_error(status_code: int) -> gspread.exceptions.APIError:
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers["Retry-After"] = "0"
+    response._content = (
+        b'{"error": {"code": %d, "message": "error", "status": "ERROR"}}'
+        % status_code
+    )
+    return gspread.exceptions.APIError(response)
+
+
+class FakeHTTPClient(gspread.http_client.HTTPClient):
+    """in-memory stand-in for the Sheets values API"""
+
+    def __init__(self) -> None:
+        self.formatted: dict[str, str] = {"C1": TODAY}
+        self.formula: dict[str, Any] = {"C1": TODAY}
+        self.sent_ranges: list[list[str]] = []
+        self.failures: list[Exception] = []
+        self.calls: list[str] = []
+
+    def _cell(self, label: str, params: Any) -> Any:
+        render = (params or {}).get("valueRenderOption")
+        source = self.formula if render == "FORMULA" else self.formatted
+        return source.get(label.split("!")[-1], "")
+
+    def values_get(self, id: str, range_name: str, params: Any = None) -> Any:
+        self.calls.append("values_get")
+        return self._value_range(range_name, params)
+
+    def _value_range(self, range_name: str, params: Any) -> Any:
+        if "!" not in range_name:
+            rows = max(gspread.utils.a1_to_rowcol(k)[0] for k in self.formatted)
+            cols = max(gspread.utils.a1_to_rowcol(k)[1] for k in self.formatted)
+            values = [
+                [
+                    self._cell(gspread.utils.rowcol_to_a1(i, j), params)
+                    for j in range(1, cols + 1)
+                ]
+                for i in range(1, rows + 1)
+            ]
+        else:
+            value = self._cell(range_name, params)
+            values = [[value]] if value != "" else []
+        return {"range": range_name, "majorDimension": "ROWS", "values": values}
+
+    def values_batch_get(
+        self, id: str, ranges: list[str], params: Any = None
+    ) -> Any:
+        self.calls.append("values_batch_get")
+        return {"valueRanges": [self._value_range(r, params) for r in ranges]}
+
+    def values_batch_update(self, id: str, body: Any = None) -> Any:
+        self.sent_ranges.append([d["range"] for d in body["data"]])
+        if self.failures:
+            raise self.failures.pop(0)
+        for d in body["data"]:
+            label = d["range"].split("!")[-1]
+            self.formatted[label] = self.formula[label] = d["values"][0][0]
+        return {}
+
+
+class FakeSpreadsheet:
+    id = "book"
+
+    def __init__(self, client: FakeHTTPClient) -> None:
+        properties = {"title": SHEETNAME, "sheetId": 0, "index": 0}
+        self.sheet = gspread.Worksheet(
+            self, properties, self.id, client  # type: ignore[arg-type]
+        )
+
+    def worksheets(self) -> list[gspread.Worksheet]:
+        return [self.sheet]
+
+
+@pytest.fixture
+def http_client(monkeypatch: pytest.MonkeyPatch) -> Iterator[FakeHTTPClient]:
+    client = FakeHTTPClient()
+
+    class FakeClient:
+        def open(self, book_name: str) -> FakeSpreadsheet:
+            return FakeSpreadsheet(client)
+
+    monkeypatch.setattr(
+        gspread_wrapper.service_account.Credentials,
+        "from_service_account_file",
+        lambda *args, **kwargs: None,
+    )
+    monkeypatch.setattr(
+        gspread_wrapper.gspread, "authorize", lambda credentials: FakeClient()
+    )
+    monkeypatch.setattr(GspreadHandler, "_shared_client", None)
+    monkeypatch.setattr(GspreadHandler, "_shared_workbooks", {})
+    yield client
+
+
+def test_flush_writes_retries_with_original_ranges(
+    http_client: FakeHTTPClient,
+) -> None:
+    http_client.failures = [api_error(429)]
+    handler = GspreadHandler("book")
+    handler.register_expense("食費", 500, "コンビニ")
+    expected = [f"'{SHEETNAME}'!C38", f"'{SHEETNAME}'!C51"]
+    assert http_client.sent_ranges == [expected, expected]
+    assert http_client.formula["C38"] == "500"
+    assert http_client.formula["C51"] == "食費: コンビニ"
+
+
+def test_add_amount_keeps_formula_showing_zero(
+    http_client: FakeHTTPClient,
+) -> None:
+    http_client.formatted["C38"] = "¥0"
+    http_client.formula["C38"] = "=500-500"
+    handler = GspreadHandler("book")
+    handler.register_expense("食費", 300)
+    assert http_client.formula["C38"] == "=500-500+300"
+
+
+def test_flush_writes_reraises_original_error(
+    http_client: FakeHTTPClient,
+) -> None:
+    http_client.failures = [api_error(429) for _ in range(5)]
+    handler = GspreadHandler("book")
+    with pytest.raises(gspread.exceptions.APIError) as excinfo:
+        handler.register_expense("食費", 500)
+    assert excinfo.value.code == 429
+    assert http_client.sent_ranges == [[f"'{SHEETNAME}'!C38"]] * 5
+
+
+def write_column_cache(cache_dir: str, label: str) -> None:
+    path = os.path.join(cache_dir, f"columns_book_{SHEETNAME}.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({TODAY: label}, f)
+
+
+def test_cached_column_is_checked_in_the_prefetch(
+    http_client: FakeHTTPClient, tmp_path: Any
+) -> None:
+    write_column_cache(str(tmp_path), "C1")
+    handler = GspreadHandler("book", cache_dir=str(tmp_path))
+    handler.register_expense("食費", 500)
+    assert http_client.calls == ["values_batch_get"]
+    assert http_client.formula["C38"] == "500"
+
+
+def test_stale_cached_column_is_refetched(
+    http_client: FakeHTTPClient, tmp_path: Any
+) -> None:
+    write_column_cache(str(tmp_path), "D1")
+    handler = GspreadHandler("book", cache_dir=str(tmp_path))
+    handler.register_expense("食費", 500, "コンビニ")
+    assert http_client.calls == ["values_batch_get", "values_get"]
+    assert http_client.formula["C38"] == "500"
+    assert http_client.formula["C51"] == "食費: コンビニ"
+    assert "D38" not in http_client.formula
+    path = os.path.join(str(tmp_path), f"columns_book_{SHEETNAME}.json")
+    with open(path, encoding="utf-8") as f:
+        assert json.load(f) == {TODAY: "C1"}